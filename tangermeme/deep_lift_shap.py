@@ -1,12 +1,22 @@
 # attribute.py
 # Contact: Jacob Schreiber <jmschreiber91@gmail.com>
 
+import copy
 import torch
+import contextlib
+import hashlib
+import threading
+import functools
+import collections
 import torch.nn.functional as F
 
 import warnings
 
 from typing import cast
+from joblib import Parallel
+from joblib import delayed
+from torch.utils.checkpoint import checkpoint
+from torch.utils.checkpoint import set_checkpoint_early_stop
 from tqdm import trange
 from .ersatz import dinucleotide_shuffle
 
@@ -64,21 +74,149 @@ def hypothetical_attributions(multipliers, X, references):
 			raise ValueError("Shape of all tensors must match.") 
 
 
-	projected_contribs = torch.zeros_like(references[0], dtype=X[0].dtype, 
-		device=X[0].device)
-	
-	for i in range(X[0].shape[1]):
-		hypothetical_input = torch.zeros_like(X[0], dtype=X[0].dtype, 
-			device=X[0].device)
-		hypothetical_input[:, i] = 1.0
-		hypothetical_diffs = hypothetical_input - references[0]
-		hypothetical_contribs = hypothetical_diffs * multipliers[0]
-
-		projected_contribs[:, i] = torch.sum(hypothetical_contribs, dim=1)
+	# For each character i, sum_j (e_i - r)_j * m_j reduces to m_i minus the
+	# reference-weighted sum of the multipliers, so no loop over the alphabet
+	# is needed.
+	reference_contribs = torch.sum(references[0] * multipliers[0], dim=1, 
+		keepdim=True)
+	projected_contribs = (multipliers[0] - reference_contribs).type(
+		X[0].dtype)
 
 	return (projected_contribs,)
 
 
+def _generate_references(references, X, random_states):
+	"""An internal function for generating one reference for each sequence.
+
+	The same seed is used for each example-reference pair regardless of the
+	batch that it ends up in. `dinucleotide_shuffle` can take one seed per
+	sequence and so handles the whole batch in a single call, whereas other
+	functions are called once per sequence.
+	"""
+
+	if references is dinucleotide_shuffle:
+		return references(X, n=1, random_state=random_states)[:, 0]
+
+	return torch.cat([references(X[i:i+1], n=1, random_state=random_state)[:, 0] 
+		for i, random_state in enumerate(random_states)])
+
+
+class _ReferenceCache(object):
+	"""An internal LRU cache of references bounded by their size in bytes.
+
+	Sequences are keyed by a SHA-1 digest of their raw bytes rather than the
+	bytes themselves so that the cache does not hold a second copy of every
+	sequence. The cache is shared across calls, and threads, and so a lock is
+	held while it is being modified.
+	"""
+
+	def __init__(self):
+		self.references = collections.OrderedDict()
+		self.lock = threading.Lock()
+		self.clear()
+
+	def clear(self):
+		with self.lock:
+			self.references.clear()
+			self.nbytes = 0
+			self.hits = 0
+			self.misses = 0
+
+	def get(self, key):
+		with self.lock:
+			reference = self.references.get(key)
+			if reference is None:
+				self.misses += 1
+			else:
+				self.hits += 1
+				self.references.move_to_end(key)
+
+			return reference
+
+	def put(self, key, reference, max_bytes):
+		with self.lock:
+			if key in self.references:
+				self.nbytes -= _nbytes(self.references.pop(key))
+
+			self.references[key] = reference
+			self.nbytes += _nbytes(reference)
+
+			while self.nbytes > max_bytes:
+				self.nbytes -= _nbytes(self.references.popitem(last=False)[1])
+
+
+def _nbytes(X):
+	return X.numel() * X.element_size()
+
+
+_REFERENCE_CACHE = _ReferenceCache()
+
+
+def _cached_references(references, X, random_states, max_bytes):
+	"""An internal function for generating references using the cache.
+
+	The reference function, the sequence, and the seed are used as the key of
+	the cache. This means that repeated calls on the same sequences, e.g. when
+	sweeping over models or targets, only need to generate each reference
+	once. References that are not in the cache are generated together.
+	"""
+
+	X = X.contiguous()
+	keys = [(references, hashlib.sha1(X[i].view(torch.uint8).numpy()).digest(), 
+		tuple(X.shape[1:]), X.dtype, random_state) 
+			for i, random_state in enumerate(random_states)]
+
+	references_ = [_REFERENCE_CACHE.get(key) for key in keys]
+	misses = [i for i, reference in enumerate(references_) if reference is None]
+
+	if len(misses) > 0:
+		generated = _generate_references(references, X[misses], 
+			[random_states[i] for i in misses])
+
+		# Each reference is copied so that the cache does not keep the whole
+		# generated batch alive.
+		for i, reference in zip(misses, generated):
+			references_[i] = reference.clone()
+			_REFERENCE_CACHE.put(keys[i], references_[i], max_bytes)
+
+	return torch.stack(references_)
+
+
+def clear_reference_cache():
+	"""Clear the references cached by `deep_lift_shap`.
+
+	When `cache_references` is used, generated references are kept in a
+	cache that is shared across calls to `deep_lift_shap`. This function frees
+	the memory used by that cache.
+	"""
+
+	_REFERENCE_CACHE.clear()
+
+
+def _to_device(X, device, buffers, name):
+	"""An internal function for moving a batch onto the device.
+
+	When moving a CPU tensor onto a GPU, the tensor is copied into a pinned
+	buffer so that the upload can be queued behind the kernels already running
+	on the device without the host waiting on it. The buffers are stored in
+	`buffers` under `name` and reused by later batches, only being allocated
+	again if a batch does not fit.
+	"""
+
+	if X.device.type != 'cpu' or torch.device(device).type != 'cuda':
+		return X.to(device)
+
+	buffer = buffers.get(name)
+	if (buffer is None or buffer.dtype != X.dtype or 
+		buffer.shape[1:] != X.shape[1:] or buffer.shape[0] < X.shape[0]):
+		buffer = torch.empty(X.shape, dtype=X.dtype, pin_memory=True)
+		buffers[name] = buffer
+
+	buffer = buffer[:X.shape[0]]
+	buffer.copy_(X)
+	return buffer.to(device, non_blocking=True)
+
+
 def _register_hooks(module): 
 	if len(module._backward_hooks) > 0:
 		return
@@ -86,7 +224,17 @@ def _register_hooks(module):
 		return
 
 	module.handles = []
-	module.handles.append(module.register_forward_hook(_f_hook))
+	module._inputs, module._outputs, module._indices = [], [], []
+
+	# Max-pooling layers are switched to also return the indices of the
+	# maximum values so that the correction does not need to pool again.
+	if isinstance(module, (torch.nn.MaxPool1d, torch.nn.MaxPool2d)):
+		module._return_indices = module.return_indices
+		module.return_indices = True
+		module.handles.append(module.register_forward_hook(_f_maxpool_hook))
+	else:
+		module.handles.append(module.register_forward_hook(_f_hook))
+
 	module.handles.append(module.register_forward_pre_hook(_fp_hook))
 	module.handles.append(module.register_full_backward_hook(_b_hook))
 
@@ -98,18 +246,170 @@ def _clear_hooks(module):
 
 		del module.handles
 
+	if hasattr(module, "_return_indices"):
+		module.return_indices = module._return_indices
+		del module._return_indices
+
+	_clear_activations(module)
+	for name in "_inputs", "_outputs", "_indices":
+		if name in module.__dict__:
+			delattr(module, name)
+
+
+def _clear_activations(module):
+	for name in "input", "output", "indices":
+		if name in module.__dict__:
+			delattr(module, name)
+
 
 def _fp_hook(module, inputs): 
-	module.input = inputs[0].clone().detach()
+	if module._SKIP_ACTIVATIONS:
+		return
+
+	input = inputs[0].detach()
+	if module._SAFE_CLONE:
+		input = input.clone()
+
+	module._inputs.append(input)
 
 
 def _f_hook(module, inputs, outputs):
-	module.output = outputs.clone().detach()
+	if module._SKIP_ACTIVATIONS:
+		return
+
+	output = outputs.detach()
+	if module._SAFE_CLONE:
+		output = output.clone()
+
+	module._outputs.append(output)
+
+
+def _f_maxpool_hook(module, inputs, outputs):
+	outputs, indices = outputs
+	if not module._SKIP_ACTIVATIONS:
+		module._indices.append(indices)
+
+	_f_hook(module, inputs, outputs)
+
+	# Only return the pooled values unless the model expects the indices too
+	if not module._return_indices:
+		return outputs
 
 
 def _b_hook(module, grad_input, grad_output):
-	return module._NON_LINEAR_OPS[type(module)](module, grad_input, 
+	# The activations are stored once per call so that modules used several
+	# times in a model work. The backward pass reaches these calls in reverse
+	# order, so the most recently stored activations belong to this call. They
+	# are released once used so that, e.g., activations recomputed for
+	# gradient checkpointing do not accumulate over the backward pass.
+	module.input = module._inputs.pop()
+	module.output = module._outputs.pop()
+	if len(module._indices) > 0:
+		module.indices = module._indices.pop()
+
+	grads = module._NON_LINEAR_OPS[type(module)](module, grad_input, 
 		grad_output)
+	_clear_activations(module)
+
+	# The rules may calculate the corrected gradient at a higher precision than
+	# the layer ran at, e.g. under autocasting, so cast back before returning.
+	return tuple(grad.type(gi.dtype) for grad, gi in zip(grads, grad_input))
+
+
+@contextlib.contextmanager
+def _skip_activations(modules):
+	"""An internal context manager that stops the hooks storing activations.
+
+	This is used for the first forward pass through a checkpointed segment,
+	whose activations are recomputed, and stored, during the backward pass.
+	"""
+
+	for module in modules:
+		module._SKIP_ACTIVATIONS = True
+
+	try:
+		yield
+	finally:
+		for module in modules:
+			module._SKIP_ACTIVATIONS = False
+
+
+def _checkpoint_sequential(model, segments, X):
+	"""An internal function for running a sequential model with checkpointing.
+
+	This mirrors `torch.utils.checkpoint.checkpoint_sequential`, in that the
+	layers are split into `segments` segments and all but the last one are
+	checkpointed, but the hooks do not store activations while running the
+	checkpointed segments. Otherwise, the stored activations would keep every
+	intermediate tensor alive and checkpointing would not save any memory.
+	Early stopping of the recomputation is disabled so that the hooks of every
+	layer in a segment are run again during the backward pass.
+	"""
+
+	layers = list(model.children())
+	size = len(layers) // segments
+
+	def _run(layers):
+		def forward(X):
+			for layer in layers:
+				X = layer(X)
+			return X
+
+		return forward
+
+	with set_checkpoint_early_stop(False):
+		for start in range(0, size * (segments - 1), size):
+			segment = layers[start:start+size]
+			modules = [module for layer in segment for module in layer.modules()]
+			context_fn = functools.partial(lambda modules: (
+				_skip_activations(modules), contextlib.nullcontext()), modules)
+
+			X = checkpoint(_run(segment), X, use_reentrant=False, 
+				context_fn=context_fn)
+
+	return _run(layers[size * (segments - 1):])(X)
+
+
+def _upcast(X):
+	"""An internal function that casts half-precision tensors to 32-bit.
+
+	The rescale rules divide differences in activations, which loses a lot of
+	precision when done in 16-bit floats, so these are calculated in at least
+	32-bit floats regardless of the precision that the layer ran at.
+	"""
+
+	if X.dtype in (torch.float16, torch.bfloat16):
+		return X.float()
+	return X
+
+
+def _rescale(module, grad_input, grad_output):
+	"""An internal function implementing the core of the `rescale` rule.
+
+	This is shared by the general-purpose nonlinear and the softmax
+	corrections. The gradient is multiplied by the ratio of the difference in
+	outputs to the difference in inputs between each example and its
+	reference, falling back to the original gradient where the difference in
+	inputs is close to zero.
+	"""
+
+	delta_in = torch.sub(*_upcast(module.input).chunk(2))
+	delta = torch.sub(*_upcast(module.output).chunk(2))
+
+	idxs = torch.abs(delta_in) < 1e-6
+	delta /= delta_in
+
+	# View the gradients as (2, n // 2, ...) so that the deltas, which are
+	# shared between the examples and the references, broadcast against both
+	# halves instead of being concatenated with themselves.
+	grad_input_ = grad_input[0].reshape(2, *delta.shape)
+	grad_output_ = grad_output[0].reshape(2, *delta.shape)
+
+	# Write the selection into the product directly so that only one full-size
+	# tensor is allocated.
+	new_grad_inp = grad_output_ * delta
+	torch.where(idxs, grad_input_, new_grad_inp, out=new_grad_inp)
+	return new_grad_inp.reshape(grad_input[0].shape)
 
 
 def _nonlinear(module, grad_input, grad_output):
@@ -120,16 +420,7 @@ def _nonlinear(module, grad_input, grad_output):
 	activations.
 	"""
 
-	delta_in_ = torch.sub(*module.input.chunk(2))
-	delta_out_ = torch.sub(*module.output.chunk(2))
-
-	delta_in = torch.cat([delta_in_, delta_in_])
-	delta_out = torch.cat([delta_out_, delta_out_])
-
-	delta = delta_out / delta_in
-	idxs = torch.abs(delta_in) < 1e-6
-
-	return (torch.where(idxs, grad_input[0], grad_output[0] * delta),)
+	return (_rescale(module, grad_input, grad_output),)
 
 
 def _softmax(module, grad_input, grad_output):
@@ -140,19 +431,10 @@ def _softmax(module, grad_input, grad_output):
 	needing to remove them and operate on the underlying logits.
 	"""
 
-	delta_in_ = torch.sub(*module.input.chunk(2))
-	delta_out_ = torch.sub(*module.output.chunk(2))
-
-	delta_in = torch.cat([delta_in_, delta_in_])
-	delta_out = torch.cat([delta_out_, delta_out_])
-
-	delta = delta_out / delta_in
-	idxs = torch.abs(delta_in) < 1e-6
-
-	grad_input_unnorm = torch.where(idxs, grad_input[0], grad_output[0] * delta)
+	new_grad_inp = _rescale(module, grad_input, grad_output)
 
 	n = grad_input[0].numel()
-	new_grad_inp = grad_input_unnorm - grad_input_unnorm.sum() * 1 / n
+	new_grad_inp -= new_grad_inp.sum() * 1 / n
 	return (new_grad_inp,)
 
 
@@ -165,43 +447,69 @@ def _maxpool(module, grad_input, grad_output):
 	"""
 
 	if isinstance(module, torch.nn.MaxPool1d):
-		pool_func, unpool_func = F.max_pool1d, F.max_unpool1d
+		unpool_func = F.max_unpool1d
 	elif isinstance(module, torch.nn.MaxPool2d):
-		pool_func, unpool_func = F.max_pool2d, F.max_unpool2d
+		unpool_func = F.max_unpool2d
 	else:
 		raise ValueError("module must be either MaxPool1d or MaxPool2d")
 
 
 	with torch.no_grad():
-		delta_in_ = torch.sub(*module.input.chunk(2))
-		delta_in = torch.cat([delta_in_, delta_in_])
+		delta_in = torch.sub(*_upcast(module.input).chunk(2))
 
-		output, output_ref = module.output.chunk(2)
+		output, output_ref = _upcast(module.output).chunk(2)
 		delta_out_xmax = torch.max(output, output_ref)
-		delta_out = torch.cat([delta_out_xmax - output_ref, 
-			output - delta_out_xmax])
 
-		_, indices = pool_func(module.input, module.kernel_size, module.stride, 
-			module.padding, module.dilation, module.ceil_mode, True)
+		# Fill both halves of the output deltas directly and then scale them
+		# by the gradient in place, avoiding the concatenation and product.
+		delta_out = output.new_empty(module.output.shape)
+		delta_out_, delta_out_ref = delta_out.chunk(2)
+		torch.sub(delta_out_xmax, output_ref, out=delta_out_)
+		torch.sub(output, delta_out_xmax, out=delta_out_ref)
+		delta_out *= grad_output[0]
 
-		unpool_ = unpool_func(grad_output[0] * delta_out, indices, 
-			module.kernel_size, module.stride, module.padding, 
-			list(module.input.shape))
-		unpool_delta, unpool_ref_delta = torch.chunk(unpool_, 2)
+		unpool_ = unpool_func(delta_out, module.indices, module.kernel_size, 
+			module.stride, module.padding, module.input.shape)
+		unpool_delta = torch.add(*torch.chunk(unpool_, 2))
+		unpool_delta /= delta_in
 
-	unpool_delta_ = unpool_delta + unpool_ref_delta
-	unpool_delta = torch.cat([unpool_delta_, unpool_delta_])
 	idxs = torch.abs(delta_in) < 1e-7
 
-	new_grad_inp = torch.where(idxs, grad_input[0], unpool_delta / delta_in)
-	return (new_grad_inp,)
+	grad_input_ = grad_input[0].reshape(2, *delta_in.shape)
+	new_grad_inp = torch.where(idxs, grad_input_, unpool_delta)
+	return (new_grad_inp.reshape(grad_input[0].shape),)
+
+
+_DEFAULT_NON_LINEAR_OPS = {
+	torch.nn.ReLU: _nonlinear,
+	torch.nn.ReLU6: _nonlinear,
+	torch.nn.RReLU: _nonlinear,
+	torch.nn.SELU: _nonlinear,
+	torch.nn.CELU: _nonlinear,
+	torch.nn.GELU: _nonlinear,
+	torch.nn.SiLU: _nonlinear,
+	torch.nn.Mish: _nonlinear,
+	torch.nn.GLU: _nonlinear,
+	torch.nn.ELU: _nonlinear,
+	torch.nn.LeakyReLU: _nonlinear,
+	torch.nn.Sigmoid: _nonlinear,
+	torch.nn.Tanh: _nonlinear,
+	torch.nn.Softplus: _nonlinear,
+	torch.nn.Softshrink: _nonlinear,
+	torch.nn.LogSigmoid: _nonlinear,
+	torch.nn.PReLU: _nonlinear,
+	torch.nn.MaxPool1d: _maxpool,
+	torch.nn.MaxPool2d: _maxpool,
+	torch.nn.Softmax: _softmax
+}
 
 
 def deep_lift_shap(model, X, args=None, target=0,  batch_size=32,
 	references=dinucleotide_shuffle, n_shuffles=20, return_references=False, 
 	hypothetical=False, warning_threshold=0.001, additional_nonlinear_ops=None,
-	print_convergence_deltas=False, raw_outputs=False, device='cuda', 
-	random_state=None, verbose=False):
+	print_convergence_deltas=False, check_convergence=True, raw_outputs=False,
+	amp=False, checkpoint_segments=0, safe_clone=False, cache_references=False,
+	device='cuda', random_state=None, verbose=False):
 	"""Calculate attributions for a set of sequences using DeepLIFT/SHAP.
 
 	This function will calculate the DeepLIFT/SHAP attributions on a set of
@@ -260,8 +568,11 @@ def deep_lift_shap(model, X, args=None, target=0,  batch_size=32,
 		total number of `X`-`reference` pairs that are processed. This means
 		that if you are in a memory-limited setting where you cannot process
 		all references for even a single sequence simultaneously that the
-		work is broken down into doing only a few references at a time. Default
-		is 32.
+		work is broken down into doing only a few references at a time. When
+		`batch_size` is at least the number of references, each batch is made
+		up of whole examples, i.e. `batch_size // n_shuffles` examples and all
+		of their references, so that every example is handled by a single
+		forward pass. Default is 32.
 
 	references: func or torch.Tensor, optional
 		If a function is passed in, this function is applied to each sequence
@@ -306,24 +617,71 @@ def deep_lift_shap(model, X, args=None, target=0,  batch_size=32,
 
 	print_convergence_deltas: bool, optional
 		Whether to print the convergence deltas for each example when using
-		DeepLiftShap. Default is False.
+		DeepLiftShap. Only used if `check_convergence=True`. Default is False.
+
+	check_convergence: bool, optional
+		Whether to calculate the convergence deltas at all. Calculating them
+		only takes an elementwise product and a sum over each batch, so
+		turning this off is only marginally faster. Default is True.
 
 	raw_outputs: bool, optional
 		Whether to return the raw outputs from the method -- in this case,
 		the multipliers for each example-reference pair -- or the processed
 		attribution values. Default is False.
 
-	device: str or torch.device, optional
+	amp: bool, optional
+		Whether to run the forward and backward passes under `torch.autocast`
+		with bfloat16, which can be much faster on GPUs with tensor cores. The
+		rescale rules are still calculated in 32-bit floats and the returned
+		attributions have the same dtype as `X`, but the attributions will be
+		less precise and so `warning_threshold` may need to be raised. Default
+		is False.
+
+	checkpoint_segments: int, optional
+		If greater than 0, split the model into this many segments and use
+		gradient checkpointing on all but the last one so that only the
+		activations at the boundaries of the segments are kept during the
+		forward pass, with the rest being recomputed one segment at a time
+		during the backward pass. This reduces the memory needed for each
+		example-reference pair, allowing a larger `batch_size` to be used,
+		and so must be at least 2 to have an effect. Requires the model to be
+		a `torch.nn.Sequential` with at least this many layers that takes in
+		no additional arguments. Default is 0, meaning no checkpointing.
+
+	safe_clone: bool, optional
+		Whether to store copies of the inputs and outputs of each nonlinear
+		operation during the forward pass instead of views of them. Copies are
+		only needed if the model modifies these tensors in-place in a manner
+		that autograd does not catch, e.g. through their `.data` attribute.
+		Default is False.
+
+	cache_references: bool or int, optional
+		Whether to cache the references generated by a reference function so
+		that later calls on the same sequences with the same function and
+		`random_state` reuse them instead of generating them again. The cache
+		is shared across calls and keeps the most recently used references
+		until it holds more than a maximum number of bytes, which is 1 GB if
+		True or this value if an integer is passed in. Call
+		`clear_reference_cache` to free the cache. Only used when
+		`references` is a function and `random_state` is not None. Default is
+		False.
+
+	device: str or torch.device or list, optional
 		The device to move the model and batches to when making predictions. If
 		set to 'cuda' without a GPU, this function will crash and must be set
-		to 'cpu'. Default is 'cuda'. 
+		to 'cpu'. If a list of devices is passed in, e.g. `['cuda:0', 'cuda:1']`,
+		the examples are split into one contiguous chunk per device and each
+		chunk is run on its own copy of the model in a separate thread. The
+		attributions are the same as if a single device had been used. Default
+		is 'cuda'. 
 
 	random_state: int or None or numpy.random.RandomState, optional
 		The random seed to use to ensure determinism. If None, the
 		process is not deterministic. Default is None. 
 
 	verbose: bool, optional
-		Whether to display a progress bar. Default is False.
+		Whether to display a progress bar. When several devices are used, the
+		progress bar only follows the first one. Default is False.
 
 
 	Returns
@@ -340,94 +698,198 @@ def deep_lift_shap(model, X, args=None, target=0,  batch_size=32,
 		`return_references = True`. 
 	"""
 
-	_NON_LINEAR_OPS = {
-		torch.nn.ReLU: _nonlinear,
-		torch.nn.ReLU6: _nonlinear,
-		torch.nn.RReLU: _nonlinear,
-		torch.nn.SELU: _nonlinear,
-		torch.nn.CELU: _nonlinear,
-		torch.nn.GELU: _nonlinear,
-		torch.nn.SiLU: _nonlinear,
-		torch.nn.Mish: _nonlinear,
-		torch.nn.GLU: _nonlinear,
-		torch.nn.ELU: _nonlinear,
-		torch.nn.LeakyReLU: _nonlinear,
-		torch.nn.Sigmoid: _nonlinear,
-		torch.nn.Tanh: _nonlinear,
-		torch.nn.Softplus: _nonlinear,
-		torch.nn.Softshrink: _nonlinear,
-		torch.nn.LogSigmoid: _nonlinear,
-		torch.nn.PReLU: _nonlinear,
-		torch.nn.MaxPool1d: _maxpool,
-		torch.nn.MaxPool2d: _maxpool,
-		torch.nn.Softmax: _softmax
-	}
+	if isinstance(references, torch.Tensor):
+		n_shuffles = references.shape[1]
+
+	if n_shuffles < 1:
+		raise RuntimeError("Must use at least one reference per example.")
+
+	if checkpoint_segments > 0:
+		if not isinstance(model, torch.nn.Sequential):
+			raise ValueError("Checkpointing requires a torch.nn.Sequential.")
+		if args is not None:
+			raise ValueError("Checkpointing cannot be used with args.")
+		if checkpoint_segments > len(model):
+			raise ValueError("Cannot use more segments than layers.")
+
+	# Attributions for different examples are independent, so when several
+	# devices are given the examples are split across them, with each chunk
+	# handled by a recursive call on its own copy of the model. Threads are
+	# used because the heavy lifting happens in PyTorch kernels that release
+	# the GIL, and they avoid pickling the model and reference function.
+	if isinstance(device, (list, tuple)):
+		devices = device[:max(min(len(device), X.shape[0]), 1)]
+
+		# The chunks are contiguous and so are taken as views rather than
+		# copies of the examples, arguments, and references.
+		Xs = torch.tensor_split(X, len(devices))
+		args_split = None
+		if args is not None:
+			args_split = list(zip(*[torch.tensor_split(a, len(devices)) 
+				for a in args]))
+
+		if isinstance(references, torch.Tensor):
+			references_split = torch.tensor_split(references, len(devices))
+		else:
+			references_split = [references] * len(devices)
+
+		# The copies must all be made here, from the untouched model, because
+		# the first shard modifies the model (device, hooks, and stored
+		# activations) while the other shards are running.
+		models = [model] + [copy.deepcopy(model) for _ in devices[1:]]
+
+		def _shard(i):
+			return deep_lift_shap(
+				model=models[i],
+				X=Xs[i],
+				args=None if args is None else args_split[i],
+				target=target,
+				batch_size=batch_size,
+				references=references_split[i],
+				n_shuffles=n_shuffles,
+				return_references=return_references,
+				hypothetical=hypothetical,
+				warning_threshold=warning_threshold,
+				additional_nonlinear_ops=additional_nonlinear_ops,
+				print_convergence_deltas=print_convergence_deltas,
+				check_convergence=check_convergence,
+				raw_outputs=raw_outputs,
+				amp=amp,
+				checkpoint_segments=checkpoint_segments,
+				safe_clone=safe_clone,
+				cache_references=cache_references,
+				device=devices[i],
+				random_state=random_state,
+				verbose=verbose and i == 0
+			)
+
+		results = Parallel(n_jobs=len(devices), backend='threading')(
+			delayed(_shard)(i) for i in range(len(devices)))
+
+		if return_references:
+			return tuple(torch.cat(r) for r in zip(*results))
+		return torch.cat(results)
+
+	if cache_references is True:
+		max_cache_bytes = 2 ** 30
+	else:
+		max_cache_bytes = int(cache_references)
 
+	_NON_LINEAR_OPS = _DEFAULT_NON_LINEAR_OPS
 	if additional_nonlinear_ops is not None:
+		_NON_LINEAR_OPS = dict(_NON_LINEAR_OPS)
 		for key, value in additional_nonlinear_ops.items():
 			_NON_LINEAR_OPS[key] = value
 
 	model = model.to(device).eval()
 	for module in model.modules():
 		module._NON_LINEAR_OPS = _NON_LINEAR_OPS
+		module._SAFE_CLONE = safe_clone
+		module._SKIP_ACTIVATIONS = False
 
-	attributions, references_, Xi, rj, attr_ = [], [], [], [], []
-	if isinstance(references, torch.Tensor):
-		n_shuffles = references.shape[1]
-	n, z = X.shape[0] * n_shuffles, 0
-
-	try:
-		model.apply(_register_hooks)
-	except Exception as e:
-		model.apply(_clear_hooks)
-		raise(e)
+	# The outputs are allocated up front and filled in as batches complete
+	if raw_outputs:
+		attributions = torch.empty(X.shape[0], n_shuffles, *X.shape[1:], 
+			dtype=X.dtype)
+	else:
+		attributions = torch.empty(X.shape, dtype=X.dtype)
 
-	for i in trange(n, disable=not verbose):
-		Xi.append(i // n_shuffles)
-		rj.append(i % n_shuffles)
+	if return_references:
+		references_ = torch.empty(X.shape[0], n_shuffles, *X.shape[1:], 
+			dtype=references.dtype if isinstance(references, torch.Tensor) 
+				else X.dtype)
+
+	n, attr_carry = X.shape[0] * n_shuffles, None
+
+	# The example and reference index of every example-reference pair, in the
+	# order that they are processed.
+	pair_idxs = torch.arange(n)
+	Xi_all, rj_all = pair_idxs // n_shuffles, pair_idxs % n_shuffles
+
+	# Batches are aligned to examples whenever all references for at least one
+	# example fit in a batch so that each example is handled by a single
+	# forward pass. Otherwise, the references for an example are split across
+	# several batches and aggregated once all of them have been processed.
+	if n_shuffles <= batch_size:
+		step = batch_size // n_shuffles * n_shuffles
+	else:
+		step = batch_size
+
+	# Batches moved onto a GPU are staged in pinned buffers that are allocated
+	# once per call. Two sets are used by alternate batches so that a batch is
+	# never written into buffers that the previous upload may still be reading.
+	pinned_buffers = [{}, {}]
+
+	def _prepare_batch(start):
+		Xi = Xi_all[start:start+step].tolist()
+		rj = rj_all[start:start+step].tolist()
+		buffers = pinned_buffers[start // step % 2]
+
+		_X = X[Xi]
+		_args = None if args is None else tuple([_to_device(a[Xi], device, 
+			buffers, ('args', i)) for i, a in enumerate(args)])
+
+		# Handle reference sequences while ensuring that the same seed is
+		# used for each shuffle even if not all shuffles are done in the
+		# same batch.
+		if isinstance(references, torch.Tensor):
+			_references = references[Xi, rj]
+		else:
+			_X_cpu = _X.cpu()
+
+			if random_state is None:
+				_references = references(_X_cpu, n=1)[:, 0]
+			elif cache_references:
+				_references = _cached_references(references, _X_cpu, 
+					[random_state + r for r in rj], max_cache_bytes)
+			else:
+				_references = _generate_references(references, _X_cpu, 
+					[random_state + r for r in rj])
 
-		if len(Xi) == batch_size or i == (n-1):
-			_X = X[Xi].cpu()
-			_args = None if args is None else tuple([a[Xi].to(device) 
-				for a in args])
+		_X = _to_device(_X, device, buffers, 'X').requires_grad_()
+		_references = _to_device(_references, device, buffers, 
+			'references').requires_grad_()
+		return Xi, rj, _X, _references, _args
 
-			# Handle reference sequences while ensuring that the same seed is
-			# used for each shuffle even if not all shuffles are done in the
-			# same batch.
-			if isinstance(references, torch.Tensor):
-				_references = references[Xi, rj]
-			else:
-				if random_state is None:
-					_references = references(_X, n=1)[:, 0]
-				else:
-					_references = torch.cat([references(_X[j:j+1], n=1, 
-						random_state=random_state+rj[j])[:, 0] 
-							for j in range(len(_X))])
+	# Hooks are registered once for the entire call and always removed at the
+	# end, even if an error is raised partway through.
+	try:
+		model.apply(_register_hooks)
+		batch = _prepare_batch(0)
 
-			_X = _X.to(device).requires_grad_()
-			_references = _references.to(device).requires_grad_()
+		for start in trange(0, n, step, disable=not verbose):
+			Xi, rj, _X, _references, _args = batch
 
 			# This next block is actually running DeepLIFT by concatenating the
 			# batch of examples and the batch of references and running the
 			# forward and backward passes that have been modified by the above
-			# hooks. In a try-except block to make sure we remove hooks if an
-			# error is raised. 
-			try:
-				X_ = torch.cat([_X, _references])
-
-				# Calculate the gradients using the rescale rule
-				with torch.autograd.set_grad_enabled(True):
-					if _args is not None:
-						_args = (torch.cat([arg, arg]) for arg in _args)
-						y = model(X_, *_args)[:, target]
-					else:
-						y = model(X_)[:, target]
-
-					multipliers = torch.autograd.grad(y.sum(), _X)[0]
-
-				# Check that the prediction-difference-from-reference is equal to
-				# the sum of the attributions
-				output_diff = torch.sub(*torch.chunk(y, 2))
+			# hooks.
+			X_ = torch.cat([_X, _references])
+
+			# Calculate the gradients using the rescale rule
+			with torch.autograd.set_grad_enabled(True), torch.autocast(
+				device_type=_X.device.type, dtype=torch.bfloat16, enabled=amp):
+				if _args is not None:
+					_args = (torch.cat([arg, arg]) for arg in _args)
+					y = model(X_, *_args)[:, target]
+				elif checkpoint_segments > 0:
+					y = _checkpoint_sequential(model, checkpoint_segments, 
+						X_)[:, target]
+				else:
+					y = model(X_)[:, target]
+
+				multipliers = torch.autograd.grad(y.sum(), _X)[0]
+
+			# The kernels for this batch are only queued at this point, so the
+			# next batch is prepared and uploaded before anything below waits
+			# on the results.
+			if start + step < n:
+				batch = _prepare_batch(start + step)
+
+			# Check that the prediction-difference-from-reference is equal to
+			# the sum of the attributions
+			if check_convergence:
+				output_diff = torch.sub(*torch.chunk(_upcast(y), 2))
 				input_diff = torch.sum((_X - _references) * multipliers, 
 					dim=(1, 2))
 				convergence_deltas = abs(output_diff - input_diff)
@@ -439,52 +901,63 @@ def deep_lift_shap(model, X, args=None, target=0,  batch_size=32,
 				if print_convergence_deltas:
 					print(convergence_deltas)
 
-			except Exception as e:
-				model.apply(_clear_hooks)
-				raise(e)
-
 			# If not returning the raw multipliers then apply the correction for
 			# character encodings
 			if raw_outputs == False:
 				multipliers = hypothetical_attributions((multipliers,), (_X,), 
 					(_references,))[0]
 
-			# attr_ is a list where each element is a tensor for the multipliers
-			# of one example so that we can chunk them together once all
-			# references for an example are 
-			attr_.extend(list(multipliers.cpu().detach()))
-
-			# When all references for a sequence have been calculated, remove
-			# that block from the list of example-reference attributions and
-			# add it to the final attribution list, averaging across references
-			# if providing the processed results.
-			while len(attr_) >= n_shuffles:
-				attr_chunk = torch.stack(attr_[:n_shuffles])
+			multipliers = multipliers.detach()
 
-				if raw_outputs == False:
-					attr_chunk = attr_chunk.mean(dim=0)
+			# Raw multipliers are written directly into their slot in the
+			# output. Otherwise, the multipliers are summed across references
+			# on the device. Because example-reference pairs are processed in
+			# order, only the last example in a batch can be incomplete, in
+			# which case its partial sum is carried over into the next batch.
+			if raw_outputs:
+				attributions[Xi, rj] = multipliers.cpu()
+			else:
+				n_before, n_after = rj[0], n_shuffles - 1 - rj[-1]
+				if n_before > 0 or n_after > 0:
+					multipliers = torch.cat([
+						multipliers.new_zeros(n_before, *multipliers.shape[1:]),
+						multipliers,
+						multipliers.new_zeros(n_after, *multipliers.shape[1:])
+					])
+
+				attr_sum = multipliers.reshape(-1, n_shuffles, 
+					*multipliers.shape[1:]).sum(dim=1)
+
+				if attr_carry is not None:
+					attr_sum[0] += attr_carry
+					attr_carry = None
+
+				if n_after > 0:
+					attr_carry = attr_sum[-1]
+					attr_sum = attr_sum[:-1]
+
+				n_done = attr_sum.shape[0]
+				if n_done > 0:
+					attr_sum /= n_shuffles
+					# Every completed example has its last reference in this
+					# batch, so its sequence is already on the device in _X.
 					if not hypothetical:
-						attr_chunk *= X[z].cpu()
+						idxs = torch.arange(1, n_done+1) * n_shuffles
+						attr_sum *= _X.detach()[idxs - n_before - 1]
 
-				attributions.append(attr_chunk)
-				attr_ = attr_[n_shuffles:]
-				z += 1
+					attributions[Xi[0]:Xi[0]+n_done] = attr_sum.cpu()
 
 			if return_references:
-				references_.extend(list(_references.cpu().detach()))
-
-			Xi, rj = [], []
+				references_[Xi, rj] = _references.detach().cpu()
 
-
-	model.apply(_clear_hooks)
-	for module in model.modules():
-		del(module._NON_LINEAR_OPS)
-
-	attributions = torch.stack(attributions)
+	finally:
+		model.apply(_clear_hooks)
+		for module in model.modules():
+			del(module._NON_LINEAR_OPS)
+			del(module._SAFE_CLONE)
+			del(module._SKIP_ACTIVATIONS)
 
 	if return_references:
-		references_ = torch.cat(references_).reshape(X.shape[0], n_shuffles, 
-			*X.shape[1:])
 		return attributions, references_
 	return attributions
 
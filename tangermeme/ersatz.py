@@ -588,11 +588,14 @@ def dinucleotide_shuffle(X, start=0, end=-1, n=20, random_state=None,
 	n: int, optional
 		The number of times to shuffle that region. Default is 20.
 
-	random_state: int or None, optional
+	random_state: int, list of ints, or None, optional
 		Whether to use a specific random seed when generating the random insert,
-		to ensure reproducibility. If None, do not use a reproducible seed.
-		Unlike other methods, cannot be a numpy.random.RandomState object. 
-		Default is None.
+		to ensure reproducibility. If an integer, the i-th sequence in `X` is
+		shuffled using a seed of `random_state + i`. If a list, it must have
+		one seed for each sequence in `X`, allowing a batch of sequences to be
+		shuffled in one call with independently chosen seeds. If None, do not
+		use a reproducible seed. Unlike other methods, cannot be a 
+		numpy.random.RandomState object. Default is None.
 
 
 	Returns
@@ -606,10 +609,18 @@ def dinucleotide_shuffle(X, start=0, end=-1, n=20, random_state=None,
 	if random_state is None:
 		random_state = numpy.random.randint(0, 9999999)
 
+	if isinstance(random_state, (int, numpy.integer)):
+		random_states = [random_state + i for i in range(X.shape[0])]
+	else:
+		random_states = list(random_state)
+		if len(random_states) != X.shape[0]:
+			raise ValueError("When a list, random_state must have one seed "
+				"for each sequence in X.")
+
 	X_shufs = []
 	for i in range(X.shape[0]):
 		insert_ = _dinucleotide_shuffle(X[i, :, start:end], n_shuffles=n, 
-			random_state=random_state+i, verbose=verbose)
+			random_state=random_states[i], verbose=verbose)
 
 		X_shuf = torch.clone(X[i:i+1]).repeat(n, 1, 1)
 		X_shuf[:, :, start:end] = insert_
@@ -18,6 +18,8 @@ from tangermeme.ersatz import dinucleotide_shuffle
 
 from tangermeme.deep_lift_shap import hypothetical_attributions
 from tangermeme.deep_lift_shap import deep_lift_shap
+from tangermeme.deep_lift_shap import clear_reference_cache
+from tangermeme.deep_lift_shap import _REFERENCE_CACHE
 from tangermeme.deep_lift_shap import _captum_deep_lift_shap
 
 from .toy_models import SumModel
@@ -243,6 +245,22 @@ def test_deep_lift_shap_convergence(X):
 			device='cpu', n_shuffles=3, random_state=0, warning_threshold=1e-10)
 
 
+def test_deep_lift_shap_check_convergence(X):
+	torch.manual_seed(0)
+	model = SmallDeepSEA()
+
+	X_attr0 = deep_lift_shap(model, X[:4], device='cpu', n_shuffles=3, 
+		random_state=0)
+
+	with warnings.catch_warnings():
+		warnings.simplefilter("error", category=RuntimeWarning)
+
+		X_attr1 = deep_lift_shap(model, X[:4], device='cpu', n_shuffles=3, 
+			random_state=0, warning_threshold=0, check_convergence=False)
+
+	assert_array_almost_equal(X_attr0, X_attr1)
+
+
 def test_deep_lift_shap_hypothetical(X):
 	torch.manual_seed(0)
 	model = FlattenDense(n_outputs=1)
@@ -304,6 +322,60 @@ def test_deep_lift_shap_random_state(X):
 	assert_raises(AssertionError, assert_array_almost_equal, X_attr0, X_attr2)
 
 
+def test_deep_lift_shap_cache_references(X):
+	torch.manual_seed(0)
+	model = FlattenDense(n_outputs=1)
+
+	clear_reference_cache()
+
+	X_attr0, refs0 = deep_lift_shap(model, X, n_shuffles=3, device='cpu', 
+		random_state=0, return_references=True)
+	assert len(_REFERENCE_CACHE.references) == 0
+
+	X_attr1, refs1 = deep_lift_shap(model, X, n_shuffles=3, device='cpu', 
+		random_state=0, return_references=True, cache_references=True)
+	assert _REFERENCE_CACHE.hits == 0
+	assert _REFERENCE_CACHE.misses == 48
+
+	X_attr2, refs2 = deep_lift_shap(model, X, n_shuffles=3, device='cpu', 
+		random_state=0, return_references=True, cache_references=True)
+	assert _REFERENCE_CACHE.hits == 48
+	assert _REFERENCE_CACHE.misses == 48
+
+	X_attr3, refs3 = deep_lift_shap(model, X, n_shuffles=3, device='cpu', 
+		random_state=1, return_references=True, cache_references=True)
+
+	assert_array_almost_equal(refs0, refs1)
+	assert_array_almost_equal(refs0, refs2)
+	assert_array_almost_equal(X_attr0, X_attr1)
+	assert_array_almost_equal(X_attr0, X_attr2)
+	assert_raises(AssertionError, assert_array_almost_equal, refs0, refs3)
+
+	clear_reference_cache()
+	assert len(_REFERENCE_CACHE.references) == 0
+
+
+def test_deep_lift_shap_cache_references_max_bytes(X):
+	torch.manual_seed(0)
+	model = FlattenDense(n_outputs=1)
+
+	clear_reference_cache()
+	nbytes = X[0].numel() * X[0].element_size()
+
+	X_attr0, refs0 = deep_lift_shap(model, X, n_shuffles=3, device='cpu', 
+		references=shuffle, random_state=0, return_references=True)
+	X_attr1, refs1 = deep_lift_shap(model, X, n_shuffles=3, device='cpu', 
+		references=shuffle, random_state=0, return_references=True, 
+		cache_references=5*nbytes)
+
+	assert len(_REFERENCE_CACHE.references) == 5
+	assert _REFERENCE_CACHE.nbytes == 5 * nbytes
+	assert_array_almost_equal(refs0, refs1)
+	assert_array_almost_equal(X_attr0, X_attr1)
+
+	clear_reference_cache()
+
+
 def test_deep_lift_shap_reference_tensor(X):
 	torch.manual_seed(0)
 	model = FlattenDense(n_outputs=1)
@@ -356,6 +428,22 @@ def test_deep_lift_shap_batch_size(X):
 	assert_array_almost_equal(X_attr0, X_attr3)
 
 
+def test_deep_lift_shap_batch_size_unaligned(X):
+	torch.manual_seed(0)
+	model = SmallDeepSEA()
+
+	X_attr0 = deep_lift_shap(model, X[:5], n_shuffles=7, batch_size=1, 
+		device='cpu', random_state=0)
+	X_attr1 = deep_lift_shap(model, X[:5], n_shuffles=7, batch_size=5, 
+		device='cpu', random_state=0)
+	X_attr2 = deep_lift_shap(model, X[:5], n_shuffles=7, batch_size=30, 
+		device='cpu', random_state=0)
+
+	assert X_attr2.shape == X[:5].shape
+	assert_array_almost_equal(X_attr0, X_attr1)
+	assert_array_almost_equal(X_attr0, X_attr2)
+
+
 def test_deep_lift_shap_n_shuffles(X):
 	torch.manual_seed(0)
 	model = FlattenDense(n_outputs=1)
@@ -387,6 +475,213 @@ def test_deep_lift_shap_shuffle_ordering(X):
 	assert_array_almost_equal(X_attr0, X_attr1)
 
 
+def test_deep_lift_shap_amp(X):
+	torch.manual_seed(0)
+	model = SmallDeepSEA()
+
+	X_attr0 = deep_lift_shap(model, X[:4], n_shuffles=3, device='cpu', 
+		random_state=0)
+	X_attr1 = deep_lift_shap(model, X[:4], n_shuffles=3, device='cpu', 
+		random_state=0, amp=True, warning_threshold=0.01)
+
+	assert X_attr1.shape == X[:4].shape
+	assert X_attr1.dtype == torch.float32
+	assert_array_almost_equal(X_attr0, X_attr1, 2)
+
+
+def test_deep_lift_shap_checkpoint_segments(X):
+	torch.manual_seed(0)
+
+	model = torch.nn.Sequential(
+		torch.nn.Conv1d(4, 8, (5,)),
+		torch.nn.ReLU(),
+		torch.nn.MaxPool1d(4),
+		torch.nn.Flatten(),
+		torch.nn.Linear(192, 10),
+		torch.nn.ReLU(),
+		torch.nn.Linear(10, 1)
+	)
+
+	X_attr0 = deep_lift_shap(model, X, device='cpu', random_state=0)
+	X_attr1 = deep_lift_shap(model, X, device='cpu', random_state=0,
+		checkpoint_segments=2)
+	X_attr2 = deep_lift_shap(model, X, device='cpu', random_state=0,
+		checkpoint_segments=3)
+
+	assert X_attr1.shape == X.shape
+	assert_array_almost_equal(X_attr0, X_attr1)
+	assert_array_almost_equal(X_attr0, X_attr2)
+
+	assert_raises(ValueError, deep_lift_shap, SmallDeepSEA(), X, 
+		device='cpu', checkpoint_segments=2)
+	assert_raises(ValueError, deep_lift_shap, model, X, device='cpu', 
+		checkpoint_segments=8)
+
+
+class ActivationProbe(torch.nn.Module):
+	def __init__(self, layers):
+		super(ActivationProbe, self).__init__()
+		self.layers = layers
+		self.n_stored = []
+
+	def forward(self, X):
+		self.n_stored.append([len(layer._inputs) for layer in self.layers])
+		return X
+
+
+def test_deep_lift_shap_checkpoint_segments_activations(X):
+	torch.manual_seed(0)
+
+	relus = [torch.nn.ReLU(), torch.nn.ReLU()]
+	probe = ActivationProbe(relus)
+
+	model = torch.nn.Sequential(
+		torch.nn.Conv1d(4, 8, (5,)),
+		relus[0],
+		torch.nn.Conv1d(8, 8, (5,)),
+		relus[1],
+		torch.nn.Flatten(),
+		torch.nn.Linear(736, 1),
+		probe
+	)
+
+	X_attr0 = deep_lift_shap(model, X, device='cpu', random_state=0)
+	assert all(n_stored == [1, 1] for n_stored in probe.n_stored)
+
+	# Only the first ReLU is in a checkpointed segment because the last
+	# segment is never checkpointed.
+	probe.n_stored = []
+	X_attr1 = deep_lift_shap(model, X, device='cpu', random_state=0,
+		checkpoint_segments=2)
+	assert len(probe.n_stored) > 0
+	assert all(n_stored == [0, 1] for n_stored in probe.n_stored)
+
+	assert_array_almost_equal(X_attr0, X_attr1)
+
+	for module in model.modules():
+		assert not hasattr(module, '_inputs')
+		assert not hasattr(module, '_outputs')
+
+
+def test_deep_lift_shap_safe_clone(X):
+	torch.manual_seed(0)
+
+	model = torch.nn.Sequential(
+		torch.nn.Conv1d(4, 8, (5,)),
+		torch.nn.ReLU(),
+		torch.nn.MaxPool1d(4),
+		torch.nn.Flatten(),
+		torch.nn.Linear(192, 10),
+		torch.nn.ReLU(),
+		torch.nn.Linear(10, 1)
+	)
+
+	X_attr0 = deep_lift_shap(model, X, device='cpu', random_state=0)
+	X_attr1 = deep_lift_shap(model, X, device='cpu', random_state=0,
+		safe_clone=True)
+
+	assert_array_almost_equal(X_attr0, X_attr1)
+
+	for module in model.modules():
+		assert not hasattr(module, 'input')
+		assert not hasattr(module, 'output')
+
+
+def test_deep_lift_shap_multiple_devices(X):
+	torch.manual_seed(0)
+	model = SmallDeepSEA()
+
+	X_attr0, refs0 = deep_lift_shap(model, X, n_shuffles=3, device='cpu', 
+		random_state=0, return_references=True)
+	X_attr1, refs1 = deep_lift_shap(model, X, n_shuffles=3, 
+		device=['cpu', 'cpu', 'cpu'], random_state=0, return_references=True)
+	X_attr2 = deep_lift_shap(model, X[:2], n_shuffles=3, 
+		device=['cpu', 'cpu', 'cpu'], random_state=0)
+
+	assert X_attr1.shape == X.shape
+	assert refs1.shape == refs0.shape
+	assert_array_almost_equal(X_attr0, X_attr1)
+	assert_array_almost_equal(refs0, refs1)
+	assert_array_almost_equal(X_attr0[:2], X_attr2)
+
+
+def test_deep_lift_shap_multiple_devices_args_references(X):
+	torch.manual_seed(0)
+	model = FlattenDense(n_outputs=1)
+	alpha = torch.randn(16, 1)
+	beta = torch.randn(16, 1)
+	references = shuffle(X, n=3, random_state=0)
+
+	X_attr0 = deep_lift_shap(model, X, args=(alpha, beta), 
+		references=references, device='cpu', random_state=0)
+	X_attr1 = deep_lift_shap(model, X, args=(alpha, beta), 
+		references=references, device=['cpu', 'cpu', 'cpu'], random_state=0)
+
+	assert X_attr1.shape == X.shape
+	assert_array_almost_equal(X_attr0, X_attr1)
+
+
+def test_deep_lift_shap_multiple_devices_cleanup(X):
+	torch.manual_seed(0)
+
+	layers = [torch.nn.Conv1d(4, 8, (3,), padding='same')]
+	for i in range(20):
+		layers += [torch.nn.ReLU(), torch.nn.MaxPool1d(1)]
+	model = torch.nn.Sequential(*layers, torch.nn.Flatten(), 
+		torch.nn.Linear(800, 1))
+
+	X_attr0 = deep_lift_shap(model, X, n_shuffles=3, device='cpu', 
+		random_state=0)
+
+	for i in range(5):
+		X_attr1 = deep_lift_shap(model, X, n_shuffles=3, 
+			device=['cpu', 'cpu', 'cpu', 'cpu'], random_state=0)
+		assert_array_almost_equal(X_attr0, X_attr1)
+
+	for module in model.modules():
+		assert len(module._forward_hooks) == 0
+		assert len(module._forward_pre_hooks) == 0
+		assert len(module._backward_hooks) == 0
+
+		for name in ('handles', '_NON_LINEAR_OPS', '_SAFE_CLONE', 
+			'_return_indices', 'input', 'output', 'indices'):
+			assert not hasattr(module, name)
+
+		if isinstance(module, torch.nn.MaxPool1d):
+			assert module.return_indices == False
+
+
+class SharedActivation(torch.nn.Module):
+	def __init__(self):
+		super(SharedActivation, self).__init__()
+		self.conv1 = torch.nn.Conv1d(4, 8, (3,), padding='same')
+		self.conv2 = torch.nn.Conv1d(8, 8, (3,), padding='same')
+		self.relu = torch.nn.ReLU()
+		self.pool = torch.nn.MaxPool1d(3, stride=1, padding=1)
+		self.dense = torch.nn.Linear(800, 1)
+
+	def forward(self, X):
+		X = self.pool(self.relu(self.conv1(X)))
+		X = self.pool(self.relu(self.conv2(X)))
+		return self.dense(X.reshape(X.shape[0], -1))
+
+
+def test_deep_lift_shap_shared_activation(X):
+	torch.manual_seed(0)
+	model = SharedActivation()
+
+	X_attr = deep_lift_shap(model, X, n_shuffles=3, device='cpu', 
+		random_state=0, warning_threshold=float("inf"))
+
+	assert X_attr.shape == X.shape
+	assert not torch.isnan(X_attr).any()
+
+	for module in model.modules():
+		assert not hasattr(module, 'input')
+		assert not hasattr(module, 'output')
+		assert not hasattr(module, 'indices')
+
+
 def test_deep_lift_shap_raw_output(X):
 	torch.manual_seed(0)
 	model = SmallDeepSEA()
@@ -820,6 +1115,23 @@ def test_deep_lift_shap_max_pool(X):
 			warning_threshold=1e-5)
 
 
+def test_deep_lift_shap_max_pool_indices(X):
+	torch.manual_seed(0)
+
+	model = torch.nn.Sequential(
+		torch.nn.Conv1d(4, 8, (5,)),
+		torch.nn.ReLU(),
+		torch.nn.MaxPool1d(4),
+		TorchSum()
+	)
+
+	X_attr = deep_lift_shap(model, X, device='cpu', random_state=0)
+
+	assert model[2].return_indices == False
+	assert not hasattr(model[2], 'indices')
+	assert not hasattr(model[2], '_return_indices')
+
+
 def test_deep_lift_shap_conv_relu_pool(X):
 	torch.manual_seed(0)
 
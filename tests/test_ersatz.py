@@ -660,6 +660,20 @@ def test_dinucleotide_shuffle():
 	assert dimotif.shape == (8, 7, 4, 13)
 
 
+def test_dinucleotide_shuffle_random_state_list():
+	X = random_one_hot((4, 4, 30), random_state=0)
+	X_shuf = dinucleotide_shuffle(X, n=3, random_state=[5, 0, 2, 2])
+
+	assert X_shuf.shape == (4, 3, 4, 30)
+	for i, seed in enumerate([5, 0, 2, 2]):
+		X_shuf_ = dinucleotide_shuffle(X[i:i+1], n=3, random_state=seed)
+		assert (X_shuf[i:i+1] == X_shuf_).all()
+
+	X_shuf0 = dinucleotide_shuffle(X, n=3, random_state=7)
+	X_shuf1 = dinucleotide_shuffle(X, n=3, random_state=[7, 8, 9, 10])
+	assert (X_shuf0 == X_shuf1).all()
+
+
 def test_dinucleotide_shuffle_composition():
 	X = random_one_hot((8, 4, 30), random_state=0)
 	X_shuf = dinucleotide_shuffle(X, random_state=0)
@@ -754,6 +768,11 @@ def test_dinucleotide_shuffle_raises_short():
 	assert_raises(ValueError, dinucleotide_shuffle, motif)
 
 
+def test_dinucleotide_shuffle_raises_random_state():
+	X = random_one_hot((4, 4, 30), random_state=0)
+	assert_raises(ValueError, dinucleotide_shuffle, X, random_state=[0, 1])
+
+
 def test_dinucleotide_shuffle_raises_ohe():
 	seq = 'ATATATTAAAATTATTATATATTTATATATTTAAAAATTTTTAATA'
 	motif = one_hot_encode(seq).unsqueeze(0) 